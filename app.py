@@ -1,9 +1,19 @@
 import streamlit as st
-import pandas as pd
-import pdfplumber
+import streamlit.components.v1 as components
+import csv
+import hashlib
+import io
 import re
+import sqlite3
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# pandas, numpy and PyMuPDF are imported inside the code that uses them, so
+# a cold start only pays for each one once a page actually needs it
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(page_title="Exam Analyzer Pro", layout="wide")
@@ -21,58 +31,176 @@ if 'start_time' not in st.session_state:
     st.session_state['start_time'] = None
 
 # --- FILE HANDLING ---
-def extract_questions_from_pdf(uploaded_file):
-    questions = []
-    with pdfplumber.open(uploaded_file) as pdf:
-        text = ""
-        for page in pdf.pages:
-            text += page.extract_text() + "\n"
+# Questions start at the beginning of a line with a number (1., 2., Q1., Q.2.
+# etc.) and run until the next numbered line; anchoring on line starts keeps
+# stray numbers inside a question (e.g. "in 1990. The") from splitting it.
+QUESTION_RE = re.compile(
+    r'^((?:Q\.?\s*)?\d+\.\s.*?)(?=\n(?:Q\.?\s*)?\d+\.\s|\Z)', re.DOTALL | re.MULTILINE
+)
+
+# Pages are read in chunks of this size, with MuPDF's cache emptied between
+# them. Plain-text extraction costs well under a millisecond per page, so
+# pages are read serially; forking workers costs more than it saves.
+PAGES_PER_CHUNK = 16
+
+def _release_page_cache():
+    # MuPDF caches decoded fonts and images in a global store (up to 256 MB by
+    # default); emptying it between chunks keeps long papers well below that,
+    # at the cost of re-decoding shared fonts once per chunk
+    import pymupdf
+    pymupdf.TOOLS.store_shrink(100)
+
+def _iter_page_texts(file_bytes):
+    # Pages are yielded in order as they are extracted, so callers can stop
+    # early without paying for the rest of the document
+    import pymupdf
+    # MuPDF prints a diagnostic line to stderr for every recoverable problem
+    # in a malformed PDF, which can run to thousands of lines on scanned papers
+    pymupdf.TOOLS.mupdf_display_errors(False)
+    with pymupdf.open(stream=file_bytes, filetype="pdf") as doc:
+        for i in range(doc.page_count):
+            # No page reference is held across the yield, so MuPDF can
+            # drop each page once its text is out
+            yield doc.load_page(i).get_text("text")
+            if (i + 1) % PAGES_PER_CHUNK == 0:
+                _release_page_cache()
+
+# MuPDF is not thread-safe, so every extraction in the process, from any
+# session or the prefetch thread, runs under this one lock. Cached so that
+# reruns of the script share it instead of each getting a new one.
+@st.cache_resource
+def _mupdf_lock():
+    return threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def extract_questions_from_pdf(file_bytes, expected_questions=None):
+    # Cached on the raw bytes so reruns, repeat uploads and "Take Another
+    # Test" skip the parse. The result is shared, not copied, between hits,
+    # so callers must treat it as read-only.
+    # With expected_questions known (from the answer key), reading stops once
+    # the question after the last expected one has started. Only that last
+    # block may run on into unread pages, so it is the only one dropped.
+    page_texts = []
+    found = 0
+    stopped_early = False
+    with _mupdf_lock(), closing(_iter_page_texts(file_bytes)) as pages:
+        for page_text in pages:
+            page_texts.append(page_text)
+            if expected_questions:
+                found += len(QUESTION_RE.findall(page_text))
+                if found > expected_questions:
+                    # On the last page the final block is complete; only
+                    # trim it when there are pages left unread
+                    stopped_early = next(pages, None) is not None
+                    break
+    text = "\n".join(page_texts)
     
-    # Regex to find questions starting with numbers (1., 2., etc.)
-    pattern = r'(\d+\.\s.*?)(?=\d+\.\s|$)' 
-    matches = re.findall(pattern, text, re.DOTALL)
+    matches = QUESTION_RE.findall(text)
+    if stopped_early:
+        matches = matches[:-1]
     
     if not matches:
         return ["Could not auto-detect questions. Please ensure PDF text is selectable and numbered (1. , 2. )."]
         
     return [m.strip() for m in matches]
 
-def load_answer_key(uploaded_key):
+@st.cache_resource(show_spinner=False)
+def load_answer_key(file_bytes):
     # Expects CSV with columns: 'Question', 'Answer' (e.g., 1, A)
+    # Shared between cache hits like the questions list; never mutate it.
+    import numpy as np
+    import pandas as pd
     try:
-        df = pd.read_csv(uploaded_key)
+        df = pd.read_csv(
+            io.BytesIO(file_bytes), usecols=[0, 1], dtype={0: 'Int32', 1: 'string'}, engine='c'
+        )
+        # Rows without a question number (e.g. a trailing "," from Excel) carry nothing
+        df = df.dropna(subset=[df.columns[0]])
         # Convert to a dictionary: {1: 'A', 2: 'B', ...}
-        # Normalize keys to integers and values to uppercase strings
-        key_dict = dict(zip(df.iloc[:, 0], df.iloc[:, 1].str.upper().str.strip()))
-        return key_dict
+        # Normalize keys to integers and values to uppercase strings; a blank
+        # answer becomes "N/A" so the question scores as Key Missing
+        keys = df.iloc[:, 0].astype(int).tolist()
+        vals = np.char.upper(np.char.strip(df.iloc[:, 1].fillna('').to_numpy().astype(str)))
+        vals = np.where(vals == '', 'N/A', vals)
+        return dict(zip(keys, vals.tolist()))
     except Exception as e:
         st.error(f"Error reading Answer Key: {e}")
         return {}
 
-# --- DATABASE (CSV) FOR HISTORY ---
-DB_FILE = 'exam_history.csv'
+# Parses a freshly uploaded paper while the user is still filling in the
+# rest of the sidebar, so Start rarely has to wait on extraction. Extraction
+# is serialized by _mupdf_lock anyway, so one worker is enough.
+@st.cache_resource
+def _prefetch_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-prefetch")
+
+def _prefetch_questions(pdf_bytes):
+    ctx = get_script_run_ctx()
+    
+    def run():
+        # Run under the submitting session's context, which Streamlit's
+        # cache expects to find on the calling thread
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return extract_questions_from_pdf(pdf_bytes)
+    
+    return _prefetch_executor().submit(run)
+
+# --- DATABASE (SQLITE) FOR HISTORY ---
+DB_FILE = 'exam_history.db'
+LEGACY_CSV_FILE = 'exam_history.csv'
+
+def _migrate_history(conn):
+    # Create the table and import any history saved by the older CSV-based
+    # versions in one transaction, marked done via user_version. SQLite rolls
+    # back the DDL too, so a failed import leaves nothing behind and is
+    # retried on the next connect; IMMEDIATE keeps two sessions from both
+    # importing.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history "
+                "(Shift TEXT, Score NUMERIC, Total_Q INTEGER, Correct INTEGER, Wrong INTEGER, Date TEXT)"
+            )
+            if os.path.isfile(LEGACY_CSV_FILE):
+                with open(LEGACY_CSV_FILE, newline='', encoding='utf-8') as f:
+                    rows = csv.reader(f)
+                    next(rows, None)
+                    # Blank lines and rows with the wrong column count are skipped
+                    conn.executemany(
+                        "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)",
+                        (row for row in rows if len(row) == 6)
+                    )
+            conn.execute("PRAGMA user_version = 1")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _connect_history():
+    # Autocommit mode, so _migrate_history controls its own transaction
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            _migrate_history(conn)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
 
 def save_score(shift_name, score, total_q, correct, wrong):
-    if not os.path.isfile(DB_FILE):
-        df = pd.DataFrame(columns=["Shift", "Score", "Total_Q", "Correct", "Wrong", "Date"])
-        df.to_csv(DB_FILE, index=False)
-    
-    new_data = {
-        "Shift": shift_name,
-        "Score": score,
-        "Total_Q": total_q,
-        "Correct": correct,
-        "Wrong": wrong,
-        "Date": pd.Timestamp.now().strftime('%Y-%m-%d %H:%M')
-    }
-    df = pd.read_csv(DB_FILE)
-    df = pd.concat([df, pd.DataFrame([new_data])], ignore_index=True)
-    df.to_csv(DB_FILE, index=False)
+    with closing(_connect_history()) as conn, conn:
+        conn.execute(
+            "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)",
+            (shift_name, score, total_q, correct, wrong, time.strftime('%Y-%m-%d %H:%M'))
+        )
 
 def get_history():
-    if os.path.isfile(DB_FILE):
-        return pd.read_csv(DB_FILE)
-    return pd.DataFrame()
+    import pandas as pd
+    if not os.path.isfile(DB_FILE) and not os.path.isfile(LEGACY_CSV_FILE):
+        return pd.DataFrame()
+    with closing(_connect_history()) as conn:
+        return pd.read_sql_query("SELECT * FROM history", conn)
 
 # --- SIDEBAR SETTINGS ---
 with st.sidebar:
@@ -89,11 +217,25 @@ with st.sidebar:
     uploaded_key = st.file_uploader("Answer Key (CSV)", type=['csv'])
     st.caption("CSV format: Col 1 = Question No, Col 2 = Option (A,B,C,D)")
     
+    # Start parsing the whole paper as soon as it is uploaded; the upload is
+    # tracked by digest so session state doesn't hold a second copy of it
+    if uploaded_pdf and not st.session_state['exam_started']:
+        pdf_bytes = uploaded_pdf.getvalue()
+        pdf_digest = hashlib.sha256(pdf_bytes).hexdigest()
+        if st.session_state.get('_prefetch_pdf') != pdf_digest:
+            stale = st.session_state.get('_prefetch_questions')
+            if stale is not None:
+                # A replaced paper's parse is no longer needed; drop it if it
+                # hasn't started yet
+                stale.cancel()
+            st.session_state['_prefetch_pdf'] = pdf_digest
+            st.session_state['_prefetch_questions'] = _prefetch_questions(pdf_bytes)
+    
     # Start Button Logic
     if uploaded_pdf and uploaded_key and not st.session_state['exam_started']:
         if st.button("Start Mock Test", type="primary"):
-            st.session_state['questions'] = extract_questions_from_pdf(uploaded_pdf)
-            st.session_state['real_answer_key'] = load_answer_key(uploaded_key)
+            st.session_state['questions'] = st.session_state['_prefetch_questions'].result()
+            st.session_state['real_answer_key'] = load_answer_key(uploaded_key.getvalue())
             st.session_state['exam_started'] = True
             st.session_state['start_time'] = time.time()
             st.rerun()
@@ -117,9 +259,39 @@ elif st.session_state['exam_started'] and not st.session_state['exam_submitted']
     questions = st.session_state['questions']
     idx = st.session_state['current_question']
     
-    # Timer
-    elapsed = int(time.time() - st.session_state['start_time'])
-    st.metric("Time Elapsed", f"{elapsed // 60}m {elapsed % 60}s")
+    # Timer ticks client-side, so it costs no reruns. It counts on from the
+    # server's elapsed time at render, so client/server clock skew can't
+    # shift it, and it copies the app's text colour and font so it follows
+    # the light/dark theme.
+    # components.html is deprecated from Streamlit 1.55, hence the upper
+    # bound on streamlit in requirements.txt.
+    elapsed_ms = int((time.time() - st.session_state['start_time']) * 1000)
+    timer_slot = st.empty()
+    with timer_slot:
+        components.html(f"""
+            <div id="timer-root">
+                <div style="font-size: 14px; opacity: 0.6;">Time Elapsed</div>
+                <div id="timer" style="font-size: 36px;"></div>
+            </div>
+            <script>
+                const start = Date.now() - {elapsed_ms};
+                const root = document.getElementById("timer-root");
+                const tick = () => {{
+                    try {{
+                        const app = window.parent.document.querySelector(".stApp")
+                            || window.parent.document.body;
+                        const style = window.parent.getComputedStyle(app);
+                        root.style.color = style.color;
+                        root.style.fontFamily = style.fontFamily;
+                    }} catch (e) {{}}
+                    const elapsed = Math.max(0, Math.floor((Date.now() - start) / 1000));
+                    document.getElementById("timer").textContent =
+                        `${{Math.floor(elapsed / 60)}}m ${{elapsed % 60}}s`;
+                }};
+                tick();
+                setInterval(tick, 1000);
+            </script>
+        """, height=80)
     st.progress((idx + 1) / len(questions))
     
     # Question Display
@@ -150,11 +322,15 @@ elif st.session_state['exam_started'] and not st.session_state['exam_submitted']
                 st.rerun()
         else:
             if st.button("Submit Exam", type="primary"):
+                st.session_state['elapsed'] = int(time.time() - st.session_state['start_time'])
                 st.session_state['exam_submitted'] = True
                 st.rerun()
 
 # 3. ANALYSIS & RESULTS STATE
 elif st.session_state['exam_submitted']:
+    import numpy as np
+    import pandas as pd
+    
     st.balloons()
     st.success("Exam Submitted! Analyzing results...")
     
@@ -162,40 +338,30 @@ elif st.session_state['exam_submitted']:
     user_answers = st.session_state['answers']
     real_key = st.session_state['real_answer_key']
     
-    correct_count = 0
-    wrong_count = 0
-    unattempted_count = 0
-    results_data = []
+    n = len(questions)
+    user = np.array([user_answers.get(i, "Unattempted") for i in range(n)], dtype=object)
+    # Lay the key out by question index once; "N/A" where the key is missing
+    correct = np.full(n, "N/A", dtype=object)
+    for q_num, ans in real_key.items():
+        if 1 <= q_num <= n:
+            correct[q_num - 1] = ans
     
-    for i in range(len(questions)):
-        q_num = i + 1
-        user_ans = user_answers.get(i, "Unattempted")
-        
-        # Fetch correct answer from uploaded key. 
-        # Default to "N/A" if key is missing for that question index
-        correct_ans = real_key.get(q_num, "N/A") 
-        
-        status = "Unattempted"
-        
-        if user_ans == "Unattempted":
-            unattempted_count += 1
-        elif user_ans == correct_ans:
-            correct_count += 1
-            status = "Correct"
-        else:
-            if correct_ans != "N/A": # Only count wrong if we know the right answer
-                wrong_count += 1
-                status = "Wrong"
-            else:
-                # If answer key is missing for this q, treat as unattempted/neutral
-                status = "Key Missing"
-            
-        results_data.append({
-            "Q No.": q_num,
-            "Your Answer": user_ans,
-            "Correct Answer": correct_ans,
-            "Status": status
-        })
+    is_unatt = user == "Unattempted"
+    is_key_missing = correct == "N/A"
+    is_correct = (user == correct) & ~is_unatt
+    # Only count wrong if we know the right answer
+    is_wrong = ~is_correct & ~is_unatt & ~is_key_missing
+    
+    correct_count = int(is_correct.sum())
+    wrong_count = int(is_wrong.sum())
+    unattempted_count = int(is_unatt.sum())
+    
+    # If answer key is missing for an attempted q, treat as neutral
+    status = np.select(
+        [is_unatt, is_correct, is_wrong],
+        ["Unattempted", "Correct", "Wrong"],
+        default="Key Missing"
+    )
 
     final_score = (correct_count * positive_marks) - (wrong_count * negative_marks)
     
@@ -205,17 +371,26 @@ elif st.session_state['exam_submitted']:
     col2.metric("Correct", f"{correct_count}", delta_color="inverse")
     col3.metric("Wrong", f"{wrong_count}", "-ve Marks")
     col4.metric("Unattempted", f"{unattempted_count}")
+    elapsed = st.session_state['elapsed']
+    st.caption(f"Time taken: {elapsed // 60}m {elapsed % 60}s")
     
     # Table
     st.subheader("Detailed Analysis")
-    df_results = pd.DataFrame(results_data)
+    # Columns are the scoring arrays themselves; copy=False skips duplicating them
+    df_results = pd.DataFrame({
+        "Q No.": np.arange(1, n + 1),
+        "Your Answer": user,
+        "Correct Answer": correct,
+        "Status": status
+    }, copy=False)
     
-    def color_status(val):
-        if val == 'Correct': return 'background-color: #d4edda; color: #155724'
-        elif val == 'Wrong': return 'background-color: #f8d7da; color: #721c24'
-        return ''
+    def color_status(col):
+        # Styles the whole column in one vectorized pass
+        values = col.to_numpy()
+        return np.where(values == 'Correct', 'background-color: #d4edda; color: #155724',
+                        np.where(values == 'Wrong', 'background-color: #f8d7da; color: #721c24', ''))
         
-    st.dataframe(df_results.style.map(color_status, subset=['Status']), use_container_width=True)
+    st.dataframe(df_results.style.apply(color_status, subset=['Status']), use_container_width=True)
     
     # Save & Reset
     col_save, col_reset = st.columns(2)